@@ -1,17 +1,23 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
 import collections
+import concurrent.futures
+import contextlib
 import dataclasses
 import datetime
 import enum
 import gzip
+import heapq
 import html
 import json
+import operator
 import os
 import pathlib
 import random
 import re
+import tempfile
 import time
 import tomllib
 import sys
@@ -20,7 +26,9 @@ from jinja2 import Environment, FileSystemLoader
 import ossapi
 
 
-URLS_PATTERN = re.compile(r"(http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+)")
+# Logs are parsed as raw bytes: URLs are ASCII anyway, and only the handful of strings that end up
+# on the page (usernames, top URLs, quotes) are ever decoded.
+URLS_PATTERN = re.compile(rb"(http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+)")
 
 
 def debug(s: str):
@@ -45,7 +53,9 @@ class GeneratorConfig:
     date: DateConfig
 
 
-def get_filter_mask(year=r"\d+", month=r"\d+"):
+# Returns a predicate telling whether a log file name belongs to the given year and month.
+def get_filename_filter(year=r"\d+", month=r"\d+"):
+    year, month = str(year), str(month)  # TOML allows plain numbers as well
     if year == "current":
         year = datetime.datetime.now().strftime("%Y")
     if month == "current":
@@ -62,7 +72,13 @@ def get_filter_mask(year=r"\d+", month=r"\d+"):
         year = prev.strftime("%Y")
         month = prev.strftime("%m")
 
-    return re.compile(r"(%s)\-(%s)\-\d+\.\w+" % (year, month), re.IGNORECASE)
+    # the usual case -- a plain YYYY-MM- prefix doesn't need a regular expression
+    if year.isdigit() and month.isdigit():
+        prefix = f"{year}-{month}-"
+        return lambda filename: filename.startswith(prefix)
+
+    filter_mask = re.compile(r"(%s)\-(%s)\-\d+\.\w+" % (year, month), re.IGNORECASE)
+    return lambda filename: filter_mask.search(filename) is not None
 
 
 class MessageType(enum.IntEnum):
@@ -71,62 +87,55 @@ class MessageType(enum.IntEnum):
     MODE_CHANGE = 2
 
 
-@dataclasses.dataclass
-class ChatMessage:
-    time: datetime.time
-    username: str
-    text: str
-    line_type: int
-
-    @classmethod
-    def parse(cls, line: str):
-        if len(line) < 7 or not ('0' <= line[0] and line[0] <= '9'):  # "HH:MM " + line contents
-            return None
-
-        contents = line.split()
-        message_time = datetime.time(*map(int, contents[0].split(":")))
-
-        match contents[1][0]:
-            # 16:32:01  * -Aki_Minoriko is listening to [https://osu.ppy.sh/beatmapsets/1712992#/3500223 S3RL feat. Sara - Dopamine]
-            case "*":
-                return cls(
-                    line_type=MessageType.ACTION,
-                    time=message_time,
-                    username=contents[2],
-                    text=" ".join(contents[3:]),
-                )
+# Positions in a ChannelStats.user_stats record.
+class UserStat(enum.IntEnum):
+    MESSAGES = 0
+    ACTIONS = 1
+    EXCLAMATIONS = 2
+    QUESTIONS = 3
+    GIVEMODES = 4
 
-            # 16:37:03 < _dopamine> юкр.
-            # 16:39:11 <@Kobold84> Юкр.
-            case "<":
-                # "< nick>" splits into ["<", "nick>", ...] — nick is in contents[2]
-                # "<@nick>" splits into ["<@nick>", ...] — nick is in contents[1]
-                if len(contents[1]) == 1:
-                    username = contents[2].rstrip(">")
-                    text = " ".join(contents[3:])
-                else:
-                    username = contents[1].lstrip("<@").rstrip(">")
-                    text = " ".join(contents[2:])
-                return cls(
-                    line_type=MessageType.REGULAR,
-                    time=message_time,
-                    username=username,
-                    text=text,
-                )
-    
-            # 16:45:29 -!- mode/#russian [+o terho] by BanchoBot
-            case "-":
-                return cls(
-                    line_type=MessageType.MODE_CHANGE,
-                    time=message_time,
-                    username=contents[4].rstrip("]"),
-                    text="",
-                )
-            case d:
-                raise RuntimeError(f"Failed to parse line {line!r} -- unknown discriminator {d!r} (second element: {contents[1]!r})")
 
-    def parse_urls(self):
-        return URLS_PATTERN.findall(self.text)
+# 16:32:01  * -Aki_Minoriko is listening to [https://osu.ppy.sh/beatmapsets/1712992#/3500223 S3RL feat. Sara - Dopamine]
+# 16:37:03 < _dopamine> юкр.
+# 16:39:11 <@Kobold84> Юкр.
+# 16:45:29 -!- mode/#russian [+o terho] by BanchoBot
+LINE_PATTERN = re.compile(
+    rb"\d\d:\d\d(?::\d\d)?\s+(?:"
+    rb"\*\s+(?P<action_username>\S+)\s*(?P<action_text>.*)"
+    rb"|<[ @+]?(?P<username>[^\s>]+)>\s*(?P<text>.*)"
+    rb"|-!-\s+\S+\s+\[\S+\s+(?P<mode_username>[^\s\]]+)"
+    rb")"
+)
+
+
+# Returns (line_type, hour, username, text) -- a plain tuple, since this runs for every line of every log.
+def parse_line(line: bytes):
+    m = LINE_PATTERN.match(line)
+    if m is None:
+        return None
+
+    hour = (line[0] - 48) * 10 + (line[1] - 48)  # the match guarantees two ASCII digits up front
+    action_username, action_text, username, text, mode_username = m.groups()
+    match m.lastgroup:
+        case "action_text":
+            return MessageType.ACTION, hour, action_username, action_text
+        case "text":
+            return MessageType.REGULAR, hour, username, text
+        case "mode_username":
+            return MessageType.MODE_CHANGE, hour, mode_username, b""
+
+
+def to_display(value: bytes) -> str:
+    return value.decode("utf-8", errors="replace")
+
+
+def parse_urls(text: bytes):
+    # every match starts with "http", and most messages have none -- skip the regex for those.
+    # (find() rather than `in`: bytes.__contains__ tries the argument as an int first, which is much slower)
+    if text.find(b"http") < 0:
+        return ()
+    return URLS_PATTERN.findall(text)
 
 
 @dataclasses.dataclass
@@ -145,40 +154,106 @@ class Url:
 
 
 class APIClient:
-    _UID_CACHE_PATH = os.path.join(os.path.dirname(__file__), ".uid-cache.toml")
+    _UID_CACHE_PATH = os.path.join(os.path.dirname(__file__), ".uid-cache.json")
+    _LEGACY_UID_CACHE_PATH = os.path.join(os.path.dirname(__file__), ".uid-cache.toml")
+    _UID_CACHE_FLUSH_EVERY = 50  # new entries; the rest is written on exit
 
     def __init__(self, credentials_path):
         self._cache = {}
+        self._unsaved_count = 0
 
         with open(credentials_path, "rb") as fd:
             data = tomllib.load(fd)
             try:
-                with open(self._UID_CACHE_PATH, "rb") as fd:
-                    self._cache = tomllib.load(fd)
-            except OSError:
-                pass
+                with open(self._UID_CACHE_PATH, "r") as fd:
+                    self._cache = json.load(fd)
+            except (OSError, ValueError):
+                # carry over entries from the older TOML cache -- they are saved as JSON on the next flush
+                try:
+                    with open(self._LEGACY_UID_CACHE_PATH, "rb") as fd:
+                        self._cache = tomllib.load(fd)
+                        self._unsaved_count = len(self._cache)
+                except (OSError, ValueError):
+                    pass
 
         self.api = ossapi.Ossapi(
             client_id=data["client_id"],
             client_secret=data["client_secret"],
         )
 
+        atexit.register(self._flush_cache)
+
     def uid(self, username):
         username = username.lower().strip().replace(" ", "_")
         if username not in self._cache:
             try:
                 data = self.api.user(f"@{username}")
                 self._cache[username] = data.id
-                try:
-                    with open(self._UID_CACHE_PATH, "a") as fd:
-                        fd.write(f"\"{username}\" = {data.id}\n")
-                except OSError:
-                    pass  # don't sweat over it
+                self._unsaved_count += 1
+                if self._unsaved_count >= self._UID_CACHE_FLUSH_EVERY:
+                    self._flush_cache()
             except Exception as e:
                 debug(e)
         
         return self._cache.get(username)
 
+    # Rewrites the whole cache through a temporary file, so that a crash never leaves it half-written.
+    def _flush_cache(self):
+        if not self._unsaved_count:
+            return
+
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                "w", dir=os.path.dirname(self._UID_CACHE_PATH), suffix=".tmp", delete=False
+            ) as fd:
+                tmp_path = fd.name
+                json.dump(self._cache, fd)
+            os.replace(tmp_path, self._UID_CACHE_PATH)
+            tmp_path = None
+            self._unsaved_count = 0
+        except (OSError, TypeError, ValueError):
+            pass  # don't sweat over it
+        finally:
+            if tmp_path is not None:
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp_path)
+
+
+def open_log(filepath):
+    filepath = pathlib.Path(filepath)
+    return (
+        gzip.open(filepath, "rb")
+        if filepath.suffix == ".gz" else
+        open(filepath, "rb")
+    )
+
+
+# Logs up to this size (uncompressed) are read and split in one go, which beats reading them
+# line by line; anything bigger is streamed to keep memory bounded in every pool worker.
+LOG_READ_WHOLE_LIMIT = 64 * 1024 * 1024
+
+
+def uncompressed_log_size(filepath):
+    size = os.path.getsize(filepath)
+    if pathlib.Path(filepath).suffix != ".gz" or size < 4:
+        return size
+
+    # The gzip trailer ends with ISIZE, the uncompressed size modulo 2**32 (of the last member only,
+    # for concatenated files) -- good enough for telling a few-MiB monthly log from a huge one.
+    with open(filepath, "rb") as fd:
+        fd.seek(-4, os.SEEK_END)
+        return max(size, int.from_bytes(fd.read(4), "little"))
+
+
+def read_log_lines(filepath):
+    with open_log(filepath) as fd:
+        if uncompressed_log_size(filepath) > LOG_READ_WHOLE_LIMIT:
+            yield from fd
+            return
+
+        yield from fd.read().splitlines()
+
 
 # Needed for two reasons: 1) avoid falling back to external tools, and 2) avoid keeping logs in memory.
 # See https://en.wikipedia.org/wiki/Reservoir_sampling for details.
@@ -188,18 +263,134 @@ class ReservoirSampler:
         self._counter = collections.Counter()
 
     def consider(self, k, v):
-        self._counter[k] += 1
-        if k not in self._storage:
+        n = self._counter.get(k, 0) + 1
+        self._counter[k] = n
+        # keep the n-th element with probability 1/n -- same as randint(1, n) == 1, minus _randbelow()'s rejection loop
+        if n == 1 or random.random() * n < 1.0:
             self._storage[k] = v
-        else:
-            curr_idx = self._counter[k]
-            chosen_element_idx = random.randint(1, curr_idx)
-            if chosen_element_idx == 1:
-                self._storage[k] = v
 
     def get(self, k):
         return self._storage.get(k)
 
+    # Combine with a sampler that has seen a disjoint part of the stream: other's element
+    # wins with probability proportional to how many elements it was picked from.
+    def merge(self, other):
+        for k, other_count in other._counter.items():
+            count = self._counter[k]
+            self._counter[k] = count + other_count
+            if k not in self._storage or random.random() * (count + other_count) < other_count:
+                self._storage[k] = other._storage[k]
+
+
+# Statistics gathered from one or more logs; partial results from separate files are combined with merge().
+@dataclasses.dataclass
+class ChannelStats:
+    # per user statistics
+    # username -> [messages, actions, exclamations, questions, givemodes] (see UserStat),
+    # so that a line costs one dict lookup no matter how many counters it bumps
+    user_stats: dict[bytes, list[int]] = dataclasses.field(default_factory=dict)
+
+    activity_graph: list[int] = dataclasses.field(default_factory=lambda: [0]*24)
+
+    # Per URL statistics: url -> [count, last used by]
+    urls: dict[bytes, list] = dataclasses.field(default_factory=dict)
+
+    # The per-line loop is the hot path of the whole script, so everything it touches is bound to locals once.
+    def many_lines(self, lines, quotes: ReservoirSampler):
+        consider_quote = quotes.consider
+        user_stats = self.user_stats
+        activity_graph = self.activity_graph
+        urls = self.urls
+        mode_change = MessageType.MODE_CHANGE
+        action = MessageType.ACTION
+        messages = UserStat.MESSAGES
+        actions = UserStat.ACTIONS
+        exclamations = UserStat.EXCLAMATIONS
+        questions = UserStat.QUESTIONS
+        givemodes = UserStat.GIVEMODES
+
+        for line in lines:
+            message = parse_line(line)
+            if message is None:
+                debug(f"Skipped line: {line.rstrip()!r}")
+                continue
+
+            line_type, hour, u, text = message
+            stats = user_stats.get(u)
+            if stats is None:
+                stats = user_stats[u] = [0, 0, 0, 0, 0]
+
+            if line_type == mode_change:
+                stats[givemodes] += 1
+                continue
+
+            activity_graph[hour] += 1
+            stats[messages] += 1
+
+            if line_type == action:
+                stats[actions] += 1
+
+            consider_quote(u, text)
+
+            for url in parse_urls(text):
+                entry = urls.get(url)
+                if entry is None:
+                    urls[url] = [1, u]
+                else:
+                    entry[0] += 1
+                    entry[1] = u
+
+            if text.find(b"!") >= 0:
+                stats[exclamations] += 1
+
+            if text.find(b"?") >= 0:
+                stats[questions] += 1
+
+    # `other` is expected to cover later logs than self.
+    def merge(self, other):
+        for u, other_stats in other.user_stats.items():
+            stats = self.user_stats.get(u)
+            if stats is None:
+                self.user_stats[u] = other_stats
+            else:
+                for i, count in enumerate(other_stats):
+                    stats[i] += count
+
+        self.activity_graph = list(map(operator.add, self.activity_graph, other.activity_graph))
+
+        for url, (other_count, other_last_used) in other.urls.items():
+            entry = self.urls.get(url)
+            if entry is None:
+                self.urls[url] = [other_count, other_last_used]
+            else:
+                entry[0] += other_count
+                entry[1] = other_last_used
+
+    # (username, count) pairs of users with a non-zero `stat`, most to least.
+    # Ties keep the order in which users first showed up in the logs (on any kind of line).
+    # Only a handful of entries is ever needed, so pick them with a heap instead of sorting everyone.
+    def top_users(self, stat: UserStat, n: int):
+        return heapq.nlargest(
+            n,
+            ((u, stats[stat]) for u, stats in self.user_stats.items() if stats[stat]),
+            key=operator.itemgetter(1),
+        )
+
+    def total(self, stat: UserStat):
+        return sum(stats[stat] for stats in self.user_stats.values())
+
+    # (url, [count, last used by]) pairs, most to least used
+    def top_urls(self, n: int):
+        return heapq.nlargest(n, self.urls.items(), key=lambda item: item[1][0])
+
+
+# Runs in worker processes, one log file per call.
+def process_file(filepath) -> tuple[ChannelStats, ReservoirSampler]:
+    stats = ChannelStats()
+    quotes = ReservoirSampler()
+    stats.many_lines(read_log_lines(filepath), quotes)
+    return stats, quotes
+
 
 class Main:
     def __init__(self, config_path: str, channel: str, api_credentials_path: str):
@@ -217,28 +408,17 @@ class Main:
             loader=FileSystemLoader(self.config.files.template_dir)
         ).get_template('template.html')
 
-        # per user statistics
-        self.user_messages: collections.Counter[str] = collections.Counter()
-        self.user_question: collections.Counter[str] = collections.Counter()
-        self.user_exclamation: collections.Counter[str] = collections.Counter()
-        self.user_actions: collections.Counter[str] = collections.Counter()
-        self.user_givemodes: collections.Counter[str] = collections.Counter()
-
+        self.stats = ChannelStats()
         self._cache_user_messages = ReservoirSampler()
 
-        self.activity_graph = [0]*24
-
-        # Per URL statistics
-        self.url_count: collections.Counter[str] = collections.Counter()
-        self.last_url_usage: dict[str, str] = collections.defaultdict(str)
-
-        filter_mask = get_filter_mask(self.config.date.year, self.config.date.month)
+        filename_filter = get_filename_filter(self.config.date.year, self.config.date.month)
         channel_logs_dir = os.path.join(self.config.files.logs_path, self.channel_name)
         matching_filenames = filter(
-            lambda filename: os.path.isfile(os.path.join(channel_logs_dir, filename)) and filter_mask.search(filename),
+            lambda filename: filename_filter(filename) and os.path.isfile(os.path.join(channel_logs_dir, filename)),
             os.listdir(channel_logs_dir)
         )
-        self.matching_paths = list(
+        # sorted, so that merging per-file results keeps the chronological order
+        self.matching_paths = sorted(
             os.path.join(channel_logs_dir, filename)
             for filename in matching_filenames
         )
@@ -248,117 +428,87 @@ class Main:
 
     def bulk_lines(self):
         now = time.time()
-        for filepath in self.matching_paths:
-            filepath = pathlib.Path(filepath)
-            file_ctx = (
-                gzip.open(filepath, "rb")
-                if filepath.suffix == ".gz" else
-                open(filepath, "r")
-            )
-            with file_ctx as fd:
-                for line in fd:
-                    self.one_line(line.strip())
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            for stats, quotes in executor.map(process_file, self.matching_paths):
+                self.stats.merge(stats)
+                self._cache_user_messages.merge(quotes)
 
         elapsed = time.time() - now
         debug(f"Parsed {len(self.matching_paths)} log(s) in {elapsed:.3}s")
 
-    def one_line(self, line):
-        message = ChatMessage.parse(line)
-        if message is None:
-            debug(f"Skipped line: {line!r}")
-            return None
-
-        u = message.username
-        match message.line_type:
-            case MessageType.MODE_CHANGE:
-                self.user_givemodes[u] += 1
-            
-            case MessageType.REGULAR | MessageType.ACTION:
-                self.activity_graph[message.time.hour] += 1
-                self.user_messages[u] += 1
-
-                if message.line_type == MessageType.ACTION:
-                    self.user_actions[u] += 1
-
-                self._cache_user_messages.consider(u, message.text)
-
-                for url in message.parse_urls():
-                    self.url_count[url] += 1
-                    self.last_url_usage[url] = u
-
-                if "!" in message.text:
-                    self.user_exclamation[u] += 1
-
-                if "?" in message.text:
-                    self.user_question[u] += 1
-
     def save_page(self):
-        users_messages_desc = self.user_messages.most_common()
+        users_messages_desc = self.stats.top_users(UserStat.MESSAGES, 35)
 
         capped_top25_len = min(25, len(users_messages_desc))
         top25 = users_messages_desc[:capped_top25_len]
 
         capped_top35_len = min(35, len(users_messages_desc))
-        runner_ups = users_messages_desc[capped_top25_len:capped_top35_len]
+        runner_ups = [
+            (to_display(username), message_count)
+            for (username, message_count) in users_messages_desc[capped_top25_len:capped_top35_len]
+        ]
 
         most_active: list[User] = []
-        for (username, message_count) in top25:
+        for (raw_username, message_count) in top25:
+            username = to_display(raw_username)
             debug(f"Fetching profile data and random quote for: {username}")
             uid = self.api.uid(username)
-            random_quote = self._cache_user_messages.get(username)
+            random_quote = self._cache_user_messages.get(raw_username) or b""
 
             most_active.append(
                 User(
                     user_id=uid,
                     username=username,
                     message_count=message_count,
-                    random_quote=html.escape(random_quote),
+                    random_quote=html.escape(to_display(random_quote)),
                 )
             )
 
 
         being = {
-            "screaming": self.user_exclamation.most_common(2),
-            "asking": self.user_question.most_common(2),
-            "telling": self.user_actions.most_common(2),
-            "modding": self.user_givemodes.most_common(2),
+            title: [(to_display(username), count) for (username, count) in self.stats.top_users(stat, 2)]
+            for title, stat in (
+                ("screaming", UserStat.EXCLAMATIONS),
+                ("asking", UserStat.QUESTIONS),
+                ("telling", UserStat.ACTIONS),
+                ("modding", UserStat.GIVEMODES),
+            )
         }
 
         top10_urls = [
             Url(
-                address=item[0],
-                count=item[1],
-                last_used_username=self.last_url_usage[item[0]]
+                address=address.decode("ascii"),
+                count=count,
+                last_used_username=to_display(last_used_username)
             )
-            for item in self.url_count.most_common(10)
+            for (address, (count, last_used_username)) in self.stats.top_urls(10)
         ]
 
         total_num = [
-            self.user_question.total(),
-            self.user_exclamation.total(),
-            self.user_actions.total(),
-            self.user_givemodes.total(),
+            self.stats.total(UserStat.QUESTIONS),
+            self.stats.total(UserStat.EXCLAMATIONS),
+            self.stats.total(UserStat.ACTIONS),
+            self.stats.total(UserStat.GIVEMODES),
         ]
 
+        os.makedirs(self.config.files.generate_to, exist_ok=True)
+        
+        template_output_path = os.path.join(
+            self.config.files.generate_to,
+            self.config.files.save_as % self.channel_name
+        )
+
+        # streamed straight into the file, without holding the whole page in memory (twice, once encoded)
         debug(f"Rendering template file for {self.channel_name}")
-        output_from_parsed_template = self.template.render(
+        self.template.stream(
             name=self.channel_name,
             most_active=most_active,
             runner_ups=runner_ups,
             being=being,
             urls_used=top10_urls,
             total=total_num,
-            activity_graph=self.activity_graph
-        )
-
-        os.makedirs(self.config.files.generate_to, exist_ok=True)
-        
-        template_output_path = os.path.join(
-            self.config.files.generate_to,
-            self.config.files.save_as % self.channel_name
-        )
-        with open(template_output_path, "wb") as fh:
-           fh.write(output_from_parsed_template.encode("utf-8"))
+            activity_graph=self.stats.activity_graph
+        ).dump(template_output_path, encoding="utf-8")
 
         json_output_path = os.path.join(
             self.config.files.generate_to,
@@ -378,9 +528,10 @@ class Main:
                     lambda url: (url.address, url.count),
                     top10_urls
                 )),
-                "activity_graph": self.activity_graph
+                "activity_graph": self.stats.activity_graph
             }
-            json.dump(data, fh)
+            # one-shot dumps() goes through the C encoder in a single call, unlike dump()'s chunk-by-chunk writes
+            fh.write(json.dumps(data))
 
 
 def main():